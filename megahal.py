@@ -26,16 +26,38 @@
 
 """Python implementation of megahal markov bot"""
 
-from time import time
+from itertools import islice, chain, imap
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from array import array
+from time import time, sleep
+from whichdb import whichdb
+import cPickle as pickle
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+import threading
+import heapq
+import Queue
+import sqlite3
 import shelve
+import signal
+import gc
+import struct
+import sys
+import traceback
+import mmap
+import json
 import random
 import math
 import os
+import re
 
 __version__ = '0.2'
 __author__ = 'Chris Jones <cjones@gruntle.org>'
 __license__ = 'BSD'
-__all__ = ['MegaHAL', 'Dictionary', 'Tree', '__version__', 'DEFAULT_ORDER', 'DEFAULT_BRAINFILE', 'DEFAULT_TIMEOUT']
+__all__ = ['MegaHAL', 'Budget', 'Pruning', 'Stats', 'ReplyCache', 'Dictionary', 'Trie', 'Tree', 'convert_brain', '__version__', 'DEFAULT_ORDER', 'DEFAULT_BRAINFILE', 'DEFAULT_TIMEOUT']
 
 DEFAULT_ORDER = 5
 DEFAULT_BRAINFILE = os.path.join(os.environ.get('HOME', ''), '.pymegahal-brain')
@@ -45,6 +67,10 @@ API_VERSION = '1.0'
 END_WORD = '<FIN>'
 ERROR_WORD = '<ERROR>'
 
+# matched against a phrase with every character replaced by its kind: a for
+# letters, d for digits and o for anything else except apostrophes
+WORD_KINDS = re.compile(r"a+(?:'a+)*|d+|['o]+")
+
 DEFAULT_BANWORDS = ['A', 'ABILITY', 'ABLE', 'ABOUT', 'ABSOLUTE', 'ABSOLUTELY', 'ACROSS', 'ACTUAL', 'ACTUALLY', 'AFTER',
                     'AGAIN', 'AGAINST', 'AGO', 'AGREE', 'ALL', 'ALMOST', 'ALONG', 'ALREADY', 'ALTHOUGH', 'ALWAYS',
                     'AN', 'AND', 'ANOTHER', 'ANY', 'ANYHOW', 'ANYTHING', 'ANYWAY', 'ARE', "AREN'T", 'AROUND', 'AS',
@@ -89,8 +115,286 @@ DEFAULT_SWAPWORDS = {"YOU'RE": "I'M", "YOU'D": "I'D", 'HATE': 'LOVE', 'YOUR': 'M
                      'DISLIKE': 'LIKE', "I'M": "YOU'RE", 'ME': 'YOU', 'MYSELF': 'YOURSELF', 'LIKE': 'DISLIKE',
                      "I'D": "YOU'D", "YOU'VE": "I'VE", 'YES': 'NO', 'MY': 'YOUR'}
 
+class Trie(object):
+
+    """Compact trie node, children are kept sorted by symbol for bisection
+
+    Nodes are copied on write: a node only changes in place while its
+    version is the one being learned, nodes of versions already published
+    are copied first, so tries published earlier never change.
+    """
+
+    __slots__ = ('symbol', 'usage', 'count', 'children', 'keys', 'totals', 'version')
+
+    def __init__(self, symbol=0):
+        self.symbol = symbol
+        self.usage = 0
+        self.count = 0
+        # leaves share empty tuples until they grow a child
+        self.children = ()
+        self.keys = ()
+        self.totals = None
+        self.version = 0
+
+    def __getstate__(self):
+        return self.symbol, self.usage, self.count, self.children
+
+    def __setstate__(self, state):
+        self.symbol, self.usage, self.count, children = state
+        if children:
+            self.children = list(children)
+            self.keys = array('i', [child.symbol for child in children])
+        else:
+            self.children = self.keys = ()
+        self.totals = None
+        self.version = 0
+
+    def add_symbol(self, symbol, count=1):
+        keys = self.keys
+        i = bisect_left(keys, symbol)
+        if i < len(keys) and keys[i] == symbol:
+            node = self.children[i]
+            if node.version != self.version:
+                node = self.children[i] = node.copy(self.version)
+        else:
+            node = self.__class__(symbol)
+            node.version = self.version
+            if keys:
+                self.children.insert(i, node)
+                keys.insert(i, symbol)
+            else:
+                self.children = [node]
+                self.keys = array('i', [symbol])
+        node.count += count
+        self.usage += count
+        self.totals = None
+        return node
+
+    def get_child(self, symbol, add=True):
+        keys = self.keys
+        i = bisect_left(keys, symbol)
+        if i < len(keys) and keys[i] == symbol:
+            return self.children[i]
+        if not add:
+            return None
+        return self.add_symbol(symbol, 0)
+
+    def find(self, symbol):
+        """Index of the child with symbol, or -1"""
+        keys = self.keys
+        i = bisect_left(keys, symbol)
+        if i < len(keys) and keys[i] == symbol:
+            return i
+        return -1
+
+    def cumulative(self):
+        """Running totals of the counts of the children, kept until a count changes"""
+        if self.totals is None:
+            totals = []
+            total = 0
+            for child in self.children:
+                total += child.count
+                totals.append(total)
+            self.totals = totals
+        return self.totals
+
+    def copy(self, version):
+        """A copy of this node that version can change, sharing its children"""
+        children, keys = self.children, self.keys
+        node = object.__new__(self.__class__)
+        node.symbol = self.symbol
+        node.usage = self.usage
+        node.count = self.count
+        node.children = list(children) if children else ()
+        node.keys = array('i', keys) if keys else ()
+        node.totals = None
+        node.version = version
+        return node
+
+    def footprint(self):
+        """Bytes taken by this node alone"""
+        size = sys.getsizeof(self)
+        if self.children:
+            size += sys.getsizeof(self.children) + sys.getsizeof(self.keys)
+        if self.totals is not None:
+            size += sys.getsizeof(self.totals)
+        return size
+
+    def measure(self):
+        """Number of nodes in this subtree and the bytes they take"""
+        nodes, size = 1, self.footprint()
+        for child in self.children:
+            child_nodes, child_size = child.measure()
+            nodes += child_nodes
+            size += child_size
+        return nodes, size
+
+    def merge(self, other, symbols=None):
+        """Add the counts of another trie to this one, symbols maps the symbols
+        of other to the symbols of this trie if they come from another dictionary"""
+        stack = [(self, other)]
+        while stack:
+            node, other = stack.pop()
+            for child in other.children:
+                symbol = child.symbol if symbols is None else symbols[child.symbol]
+                stack.append((node.add_symbol(symbol, child.count), child))
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Convert a Tree from an older brain"""
+        node = cls(tree.symbol)
+        node.usage = tree.usage
+        node.count = tree.count
+        if tree.children:
+            children = sorted(tree.children, key=lambda child: child.symbol)
+            node.children = [cls.from_tree(child) for child in children]
+            node.keys = array('i', [child.symbol for child in children])
+        return node
+
+
+class StoredTrie(Trie):
+
+    """Trie node backed by a SQLiteStore, which is told about every change"""
+
+    __slots__ = ('id', 'store')
+
+    def __init__(self, symbol=0, id=None, store=None):
+        Trie.__init__(self, symbol)
+        self.id = id
+        self.store = store
+
+    def add_symbol(self, symbol, count=1):
+        node = Trie.add_symbol(self, symbol, count)
+        self.store.touch(node, self)
+        return node
+
+    def copy(self, version):
+        node = Trie.copy(self, version)
+        node.id = self.id
+        node.store = self.store
+        return node
+
+
+class UnloadedTrie(StoredTrie):
+
+    """StoredTrie whose children are still on disk
+
+    Reading its children turns the node into a plain StoredTrie, so loaded
+    nodes pay nothing for being loaded lazily.
+    """
+
+    __slots__ = ()
+
+    def load(self):
+        store = self.store
+        with store.lock:
+            # replies load nodes in threads of their own, the children are
+            # in place before other threads can see the node as loaded
+            if self.__class__ is UnloadedTrie:
+                children, keys = store.load_children(self)
+                Trie.children.__set__(self, children)
+                Trie.keys.__set__(self, keys)
+                self.__class__ = StoredTrie
+
+    def footprint(self):
+        return sys.getsizeof(self)
+
+    def measure(self):
+        # counted on disk, without loading it
+        return self.store.measure_subtree(self)
+
+    @property
+    def children(self):
+        self.load()
+        return self.children
+
+    @property
+    def keys(self):
+        self.load()
+        return self.keys
+
+
+class MappedTrie(object):
+
+    """Read-only view of a trie node inside a MappedStore"""
+
+    __slots__ = ('store', 'symbol', 'count', 'usage', 'first', 'size', '_children')
+
+    def __init__(self, store, index):
+        self.store = store
+        self.symbol, self.count, self.usage, self.first, self.size = store.node(index)
+        self._children = None
+
+    @property
+    def children(self):
+        if self._children is None:
+            self._children = [MappedTrie(self.store, i) for i in xrange(self.first, self.first + self.size)]
+        return self._children
+
+    @property
+    def keys(self):
+        return MappedKeys(self.store, self.first, self.size)
+
+    def add_symbol(self, symbol, count=1):
+        raise ValueError('This brain is read-only')
+
+    def get_child(self, symbol, add=True):
+        i = self.find(symbol)
+        if i >= 0:
+            return MappedTrie(self.store, self.first + i)
+        if add:
+            raise ValueError('This brain is read-only')
+        return None
+
+    def find(self, symbol):
+        symbol_at = self.store.symbol_at
+        lo, hi = self.first, self.first + self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if symbol_at(mid) < symbol:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.first + self.size and symbol_at(lo) == symbol:
+            return lo - self.first
+        return -1
+
+    def cumulative(self):
+        totals = self.store.totals.get(self.first)
+        if totals is None:
+            totals = []
+            total = 0
+            for i in xrange(self.first, self.first + self.size):
+                total += self.store.node(i)[1]
+                totals.append(total)
+            self.store.totals[self.first] = totals
+        return totals
+
+
+class MappedKeys(object):
+
+    """Symbols of the children of a MappedTrie, read in place"""
+
+    __slots__ = ('store', 'first', 'size')
+
+    def __init__(self, store, first, size):
+        self.store = store
+        self.first = first
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.size:
+            raise IndexError('child out of range')
+        return self.store.symbol_at(self.first + i)
+
+
 class Tree(object):
 
+    """Original trie node, kept so that older brains can be unpickled"""
+
     def __init__(self, symbol=0):
         self.symbol = symbol
         self.usage = 0
@@ -118,247 +422,1989 @@ class Tree(object):
 
 class Dictionary(list):
 
+    """List of words indexed by symbol, with a hash index for word lookups"""
+
+    def __getattr__(self, name):
+        # the index is never pickled, so brains saved by older versions (and
+        # unpickled copies, which bypass __init__) build it on first use
+        if name != '_index':
+            raise AttributeError(name)
+        index = {}
+        for symbol, word in enumerate(self):
+            index.setdefault(word, symbol)
+        self._index = index
+        return index
+
+    def __getstate__(self):
+        return {}
+
+    def _invalidate(self):
+        self.__dict__.pop('_index', None)
+
     def add_word(self, word):
         try:
-            return self.index(word)
-        except ValueError:
+            return self._index[word]
+        except KeyError:
+            # the word is in place before replies can look it up
+            symbol = len(self)
+            list.append(self, word)
+            self._index[word] = symbol
+            return symbol
+
+    def find_word(self, word):
+        return self._index.get(word, 0)
+
+    def index(self, word):
+        try:
+            return self._index[word]
+        except KeyError:
+            raise ValueError('%r is not in dictionary' % (word,))
+
+    def __contains__(self, word):
+        return word in self._index
+
+    def append(self, word):
+        self._index.setdefault(word, len(self))
+        list.append(self, word)
+
+    def extend(self, words):
+        for word in words:
             self.append(word)
-            return len(self) - 1
+
+    def __iadd__(self, words):
+        self.extend(words)
+        return self
+
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self._invalidate()
+        return self
+
+    def insert(self, i, word):
+        list.insert(self, i, word)
+        self._invalidate()
+
+    def remove(self, word):
+        list.remove(self, word)
+        self._invalidate()
+
+    def pop(self, *args):
+        word = list.pop(self, *args)
+        self._invalidate()
+        return word
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._invalidate()
+
+    def reverse(self):
+        list.reverse(self)
+        self._invalidate()
+
+    def __setitem__(self, i, word):
+        list.__setitem__(self, i, word)
+        self._invalidate()
+
+    def __delitem__(self, i):
+        list.__delitem__(self, i)
+        self._invalidate()
+
+    def __setslice__(self, i, j, words):
+        list.__setslice__(self, i, j, words)
+        self._invalidate()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._invalidate()
+
+
+class MappedDictionary(object):
+
+    """Read-only Dictionary inside a MappedStore, words are bisected in place"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return self.store.nwords
+
+    def __getitem__(self, symbol):
+        if not 0 <= symbol < self.store.nwords:
+            raise IndexError('symbol out of range')
+        return self.store.word(symbol)
+
+    def __iter__(self):
+        for symbol in xrange(self.store.nwords):
+            yield self.store.word(symbol)
+
+    def __contains__(self, word):
+        return self.lookup(word) is not None
+
+    def lookup(self, word):
+        store = self.store
+        lo, hi = 0, store.nwords
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if store.word(store.sorted_symbol(mid)) < word:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < store.nwords:
+            symbol = store.sorted_symbol(lo)
+            if store.word(symbol) == word:
+                return symbol
+
+    def add_word(self, word):
+        symbol = self.lookup(word)
+        if symbol is None:
+            raise ValueError('This brain is read-only')
+        return symbol
 
     def find_word(self, word):
+        symbol = self.lookup(word)
+        if symbol is None:
+            return 0
+        return symbol
+
+    def index(self, word):
+        symbol = self.lookup(word)
+        if symbol is None:
+            raise ValueError('%r is not in dictionary' % (word,))
+        return symbol
+
+
+class ShelveStore(object):
+
+    """Brain kept as pickled objects in a shelve, every sync rewrites all of it"""
+
+    readonly = False
+    incremental = False
+
+    def __init__(self, file, readonly=False):
+        self.readonly = readonly
+        self.db = shelve.open(file, 'r' if readonly else 'c', writeback=not readonly)
+        # syncing empties the writeback cache, so the objects the brain keeps
+        # changing are put back before every sync
+        self.live = {}
+
+    def __getitem__(self, key):
+        return self.db[key]
+
+    def setdefault(self, key, default):
+        value = self.live[key] = self.db.setdefault(key, default)
+        return value
+
+    def get_tree(self, key):
+        if self.readonly:
+            tree = self.db[key]
+            return Trie.from_tree(tree) if isinstance(tree, Tree) else tree
+        if isinstance(self.db.setdefault(key, Trie()), Tree):
+            self.db[key] = Trie.from_tree(self.db[key])
+        value = self.live[key] = self.db[key]
+        return value
+
+    def set_tree(self, key, tree):
+        # every version learning publishes comes here, it is written on sync
+        self.live[key] = self.db.cache[key] = tree
+
+    def get_dictionary(self):
+        if self.readonly:
+            return self.db['dictionary']
+        return self.setdefault('dictionary', Dictionary())
+
+    def changed(self, node):
+        pass
+
+    def remove(self, node):
+        pass
+
+    def renumber(self, symbols, dictionary):
+        pass
+
+    def after_fork(self):
+        pass
+
+    def sync(self):
+        if self.readonly:
+            return
+        self.db.cache.update(self.live)
+        self.db.sync()
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+class MemoryStore(dict):
+
+    """Brain that only lives in memory, shards of a sharded training are kept in these"""
+
+    readonly = False
+    incremental = False
+
+    def get_tree(self, key):
+        return self.setdefault(key, Trie())
+
+    def set_tree(self, key, tree):
+        self[key] = tree
+
+    def get_dictionary(self):
+        return self.setdefault('dictionary', Dictionary())
+
+    def changed(self, node):
+        pass
+
+    def remove(self, node):
+        pass
+
+    def renumber(self, symbols, dictionary):
+        pass
+
+    def after_fork(self):
+        pass
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SQLiteStore(object):
+
+    """Brain kept in sqlite, nodes are loaded on demand and only dirty nodes are synced"""
+
+    readonly = False
+    incremental = True
+    # fanout -> bytes of the children list and keys array of a loaded node
+    children_sizes = {}
+
+    schema = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB);
+        CREATE TABLE IF NOT EXISTS words (symbol INTEGER PRIMARY KEY, word TEXT);
+        CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, parent INTEGER,
+                                          symbol INTEGER, count INTEGER, usage INTEGER);
+        CREATE INDEX IF NOT EXISTS nodes_parent ON nodes (parent, symbol);
+        """
+
+    def __init__(self, file, readonly=False):
+        self.file = file
+        self.readonly = readonly
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if not readonly:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.executescript(self.schema)
+        self.next_id = (self.db.execute('SELECT max(id) FROM nodes').fetchone()[0] or 0) + 1
+        self.meta = {}
+        # id -> node for every node to write, the latest copy of it, and
+        # id -> parent id for the ones not in the database yet
+        self.dirty = {}
+        self.created = {}
+        # ids of pruned subtrees to delete
+        self.removed = []
+        self.dictionary = None
+        self.saved_words = 0
+
+    @property
+    def db(self):
+        # every thread reads through a connection of its own, so replies
+        # loading nodes never wait for a sync
+        try:
+            return self.local.db
+        except AttributeError:
+            db = self.local.db = self.connect()
+            return db
+
+    def connect(self):
+        db = sqlite3.connect(self.file, check_same_thread=False)
+        db.text_factory = str
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def after_fork(self):
+        # sqlite connections (and a lock held by another thread) must not be
+        # shared with a forked child
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, key):
+        try:
+            return self.meta[key]
+        except KeyError:
+            row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                raise KeyError(key)
+            value = self.meta[key] = pickle.loads(str(row[0]))
+            return value
+
+    def __setitem__(self, key, value):
+        self.meta[key] = value
+
+    def setdefault(self, key, default):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def get_tree(self, key):
+        id = self.setdefault(key, None)
+        if id is None:
+            node = self.new_node(0, None)
+            self[key] = node.id
+        else:
+            row = self.db.execute('SELECT symbol, count, usage FROM nodes WHERE id = ?', (id,)).fetchone()
+            node = self.make_node(id, *row)
+        return node
+
+    def set_tree(self, key, tree):
+        # copies of a node keep its id
+        pass
+
+    def get_dictionary(self):
+        if self.dictionary is None:
+            self.dictionary = Dictionary(word for word, in self.db.execute('SELECT word FROM words ORDER BY symbol'))
+            self.saved_words = len(self.dictionary)
+        return self.dictionary
+
+    def new_node(self, symbol, parent):
+        node = StoredTrie(symbol, self.next_id, self)
+        self.next_id += 1
+        self.dirty[node.id] = node
+        self.created[node.id] = parent
+        return node
+
+    def make_node(self, id, symbol, count, usage):
+        node = StoredTrie(symbol, id, self)
+        node.count = count
+        node.usage = usage
+        if usage:
+            node.__class__ = UnloadedTrie
+        return node
+
+    def load_children(self, node):
+        rows = self.db.execute('SELECT id, symbol, count, usage FROM nodes WHERE parent = ? ORDER BY symbol',
+                               (node.id,)).fetchall()
+        if rows:
+            return [self.make_node(*row) for row in rows], array('i', [row[1] for row in rows])
+        return (), ()
+
+    def touch(self, node, parent):
+        """Called by StoredTrie.add_symbol for every node whose counts changed"""
+        if node.id is None:
+            node.id = self.next_id
+            node.store = self
+            self.next_id += 1
+            self.created[node.id] = parent.id
+        self.dirty[node.id] = node
+        self.dirty[parent.id] = parent
+
+    def changed(self, node):
+        """Called for a node whose usage went down when its children were pruned"""
+        self.dirty[node.id] = node
+
+    def remove(self, node):
+        """Called for the root of every pruned subtree, which is deleted on sync"""
+        if node.id not in self.created:
+            self.removed.append(node.id)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            self.dirty.pop(node.id, None)
+            self.created.pop(node.id, None)
+            if node.__class__ is not UnloadedTrie:
+                stack.extend(node.children)
+
+    def measure_subtree(self, node):
+        """Number of nodes in the subtree of node and the bytes they take once loaded"""
+        fanouts = [row[0] for row in self.db.execute(
+            'WITH RECURSIVE subtree(id, parent) AS (SELECT ?, NULL UNION ALL '
+            'SELECT nodes.id, nodes.parent FROM nodes JOIN subtree ON nodes.parent = subtree.id) '
+            'SELECT count(*) FROM subtree WHERE parent IS NOT NULL GROUP BY parent', (node.id,))]
+        nodes = 1 + sum(fanouts)
+        return nodes, nodes * sys.getsizeof(node) + sum(self.children_size(fanout) for fanout in fanouts)
+
+    def children_size(self, fanout):
+        try:
+            return self.children_sizes[fanout]
+        except KeyError:
+            size = self.children_sizes[fanout] = (sys.getsizeof([None for i in xrange(fanout)]) +
+                                                  sys.getsizeof(array('i', [0] * fanout)))
+            return size
+
+    def renumber(self, symbols, dictionary):
+        """Called once the nodes in memory have the new symbols, symbols maps
+        every old symbol still in use to its new one"""
+        with self.db:
+            self.db.execute('CREATE TEMP TABLE IF NOT EXISTS renumber (old INTEGER PRIMARY KEY, new INTEGER)')
+            self.db.execute('DELETE FROM renumber')
+            self.db.executemany('INSERT INTO renumber (old, new) VALUES (?, ?)',
+                                ((old, new) for old, new in enumerate(symbols) if new >= 0))
+            self.db.execute('UPDATE nodes SET symbol = (SELECT new FROM renumber WHERE old = nodes.symbol)')
+            self.db.execute('DELETE FROM words')
+            self.db.executemany('INSERT INTO words (symbol, word) VALUES (?, ?)', enumerate(dictionary))
+        self.saved_words = len(dictionary)
+
+    def sync(self):
+        if self.readonly:
+            return
+        dirty, created = self.dirty, self.created
+        with self.db:
+            self.db.executemany('INSERT INTO nodes (id, parent, symbol, count, usage) VALUES (?, ?, ?, ?, ?)',
+                                ((id, parent, dirty[id].symbol, dirty[id].count, dirty[id].usage)
+                                 for id, parent in created.iteritems()))
+            self.db.executemany('UPDATE nodes SET count = ?, usage = ? WHERE id = ?',
+                                ((node.count, node.usage, id) for id, node in dirty.iteritems() if id not in created))
+            self.db.executemany('DELETE FROM nodes WHERE id IN (WITH RECURSIVE subtree(id) AS (SELECT ? UNION ALL '
+                                'SELECT nodes.id FROM nodes JOIN subtree ON nodes.parent = subtree.id) '
+                                'SELECT id FROM subtree)', ((id,) for id in self.removed))
+            if self.dictionary is not None:
+                self.db.executemany('INSERT INTO words (symbol, word) VALUES (?, ?)',
+                                    enumerate(self.dictionary[self.saved_words:], self.saved_words))
+                self.saved_words = len(self.dictionary)
+            self.db.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                ((key, buffer(pickle.dumps(value, 2))) for key, value in self.meta.iteritems()))
+        self.created.clear()
+        self.dirty.clear()
+        del self.removed[:]
+
+    def close(self):
+        self.sync()
+        self.db.close()
+
+
+class MappedStore(object):
+
+    """Read-only brain in a flat file that is memory-mapped and read in place
+
+    The file holds a header, the pickled word lists, the dictionary (an
+    offset table, the symbols in sorted word order and the word text) and
+    every trie node as a fixed size record.  Nodes are stored breadth first
+    so the children of a node are consecutive records sorted by symbol.
+    """
+
+    readonly = True
+    incremental = False
+    magic = 'MEGAHAL\x00'
+    version = 1
+    header = struct.Struct('<8sIIQQQQQQQ')
+    record = struct.Struct('<iIIII')
+    offset = struct.Struct('<I')
+    span = struct.Struct('<II')
+    key = struct.Struct('<i')
+
+    def __init__(self, file):
+        self.fp = open(file, 'rb')
+        self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.nwords, self.nnodes, meta, meta_size, self.offsets,
+         self.sorted, self.words, self.nodes) = self.header.unpack_from(self.map)
+        if magic != self.magic or version != self.version:
+            raise ValueError('%s is not a mapped brain of version %d' % (file, self.version))
+        self.meta = pickle.loads(self.map[meta:meta + meta_size])
+        # running totals of the children of the nodes replies were sampled from
+        self.totals = LRUCache()
+
+    def __getitem__(self, key):
+        return self.meta[key]
+
+    def setdefault(self, key, default):
+        return self.meta.get(key, default)
+
+    def get_tree(self, key):
+        return MappedTrie(self, ('forward', 'backward').index(key))
+
+    def set_tree(self, key, tree):
+        raise ValueError('This brain is read-only')
+
+    def changed(self, node):
+        raise ValueError('This brain is read-only')
+
+    def remove(self, node):
+        raise ValueError('This brain is read-only')
+
+    def renumber(self, symbols, dictionary):
+        raise ValueError('This brain is read-only')
+
+    def get_dictionary(self):
+        return MappedDictionary(self)
+
+    def after_fork(self):
+        pass
+
+    def node(self, index):
+        return self.record.unpack_from(self.map, self.nodes + self.record.size * index)
+
+    def symbol_at(self, index):
+        return self.key.unpack_from(self.map, self.nodes + self.record.size * index)[0]
+
+    def word(self, symbol):
+        start, end = self.span.unpack_from(self.map, self.offsets + self.offset.size * symbol)
+        return self.map[self.words + start:self.words + end]
+
+    def sorted_symbol(self, index):
+        return self.offset.unpack_from(self.map, self.sorted + self.offset.size * index)[0]
+
+    def sync(self):
+        pass
+
+    def close(self):
+        self.map.close()
+        self.fp.close()
+
+    @classmethod
+    def write(cls, file, meta, forward, backward, dictionary):
+        """Write a mapped brain with the given trees, dictionary and pickled metadata"""
+        words = list(dictionary)
+        meta = pickle.dumps(meta, 2)
+        with open(file, 'wb') as fp:
+            fp.write('\0' * cls.header.size)
+            fp.write(meta)
+            offsets = fp.tell()
+            position = 0
+            table = array('I', [0])
+            for word in words:
+                position += len(word)
+                table.append(position)
+            table.tofile(fp)
+            sorted_symbols = fp.tell()
+            array('I', sorted(xrange(len(words)), key=words.__getitem__)).tofile(fp)
+            start = fp.tell()
+            for word in words:
+                fp.write(word)
+            nodes = fp.tell()
+            queue = [forward, backward]
+            for node in queue:
+                children = node.children
+                fp.write(cls.record.pack(node.symbol, node.count, node.usage, len(queue), len(children)))
+                queue.extend(children)
+            fp.seek(0)
+            fp.write(cls.header.pack(cls.magic, cls.version, len(words), len(queue), cls.header.size, len(meta),
+                                     offsets, sorted_symbols, start, nodes))
+
+
+def open_store(file, readonly=False):
+    """Shelve brains from older versions are kept as they are, mapped brains are
+    detected by their header and anything else is sqlite, no file at all keeps
+    the brain in memory.  A readonly store never writes to its file."""
+    if file is None:
+        return MemoryStore()
+    if whichdb(file):
+        return ShelveStore(file, readonly)
+    if os.path.isfile(file):
+        with open(file, 'rb') as fp:
+            if fp.read(len(MappedStore.magic)) == MappedStore.magic:
+                return MappedStore(file)
+    return SQLiteStore(file, readonly)
+
+
+def convert_brain(source, target):
+    """Copy a shelve brain into a new sqlite brain"""
+    if not whichdb(source):
+        raise ValueError('%s is not a shelve brain' % source)
+    if os.path.exists(target):
+        raise ValueError('%s already exists' % target)
+    old = shelve.open(source, 'r')
+    new = SQLiteStore(target)
+    try:
+        for key in 'api', 'order', 'banwords', 'auxwords', 'swapwords':
+            new[key] = old[key]
+        new.get_dictionary().extend(old['dictionary'])
+        for key in 'forward', 'backward':
+            tree = old[key]
+            if isinstance(tree, Tree):
+                tree = Trie.from_tree(tree)
+            stack = [(tree, new.get_tree(key))]
+            while stack:
+                src, dst = stack.pop()
+                dst.count = src.count
+                dst.usage = src.usage
+                if src.children:
+                    dst.children = [new.new_node(child.symbol, dst.id) for child in src.children]
+                    dst.keys = array('i', src.keys)
+                    stack.extend(zip(src.children, dst.children))
+        new.sync()
+    finally:
+        new.close()
+        old.close()
+
+
+class LRUCache(object):
+
+    """Bounded cache that forgets the least recently used entries
+
+    Entries are kept in two generations, using an entry moves it into the
+    newer one and the older one is dropped when the newer one fills up,
+    which is close to least recently used without keeping entries in order.
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.new = {}
+        self.old = {}
+
+    def __len__(self):
+        return len(self.new) + len(self.old)
+
+    def get(self, key, default=None):
+        try:
+            return self.new[key]
+        except KeyError:
+            pass
+        try:
+            value = self.old.pop(key)
+        except KeyError:
+            return default
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        if len(self.new) >= self.size // 2:
+            self.old = self.new
+            self.new = {}
+        self.new[key] = value
+
+    def discard(self, key):
+        self.new.pop(key, None)
+        self.old.pop(key, None)
+
+    def keys(self):
+        return self.new.keys() + self.old.keys()
+
+    def clear(self):
+        self.new = {}
+        self.old = {}
+
+    def copy(self):
+        cache = LRUCache(self.size)
+        cache.new = self.new.copy()
+        cache.old = self.old.copy()
+        return cache
+
+
+class Budget(object):
+
+    """Limits on how long get_reply keeps looking for a better reply
+
+    The search stops after timeout seconds or at the absolute deadline
+    (a time.time() value), after trying candidates replies, once a reply
+    scores at least surprise, or after stall replies in a row that were
+    no better than the best so far, whichever comes first.
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT, candidates=None, surprise=None, stall=None, deadline=None):
+        if timeout is None and candidates is None and deadline is None:
+            raise ValueError('A budget needs a timeout, a deadline or a number of candidates')
+        self.timeout = timeout
+        self.candidates = candidates
+        self.surprise = surprise
+        self.stall = stall
+        self.deadline = deadline
+
+    def share(self, workers=1):
+        """The budget of each of workers that start searching now"""
+        deadline = self.deadline
+        if self.timeout is not None:
+            deadline = min(deadline or float('inf'), time() + self.timeout)
+        candidates = self.candidates
+        if candidates is not None:
+            candidates = -(-candidates // workers)
+        return Budget(None, candidates, self.surprise, self.stall, deadline)
+
+    def exhausted(self, tries, stalled, surprise):
+        return ((self.candidates is not None and tries >= self.candidates) or
+                (self.surprise is not None and surprise >= self.surprise) or
+                (self.stall is not None and stalled >= self.stall) or
+                (self.deadline is not None and time() >= self.deadline))
+
+
+class Pruning(object):
+
+    """Limits on how big the tries of a brain may grow
+
+    n-grams seen fewer than threshold times are pruned, and with a budget
+    of nodes or bytes (for both tries, as counted by sys.getsizeof) the
+    threshold is raised as far as it takes to fit.  Given to a brain that
+    learns, one slice of the tries is pruned every `every` phrases, so all
+    of them are once every slices * every phrases, and the threshold of
+    each sweep is fitted to the budget by what the one before it saw.
+    """
+
+    slices = 16
+
+    def __init__(self, threshold=2, nodes=None, bytes=None, every=1000):
+        if threshold < 1:
+            raise ValueError('A pruning threshold must be at least 1')
+        self.threshold = threshold
+        self.nodes = nodes
+        self.bytes = bytes
+        self.every = every
+        # nodes and bytes pruned so far
+        self.removed = self.reclaimed = 0
+        # where the incremental sweep is at
+        self.learned = 0
+        self.slice = 0
+        self.current = threshold
+        self.reset()
+
+    def reset(self):
+        # count -> number and bytes of the nodes seen with it
+        self.counts = defaultdict(int)
+        self.sizes = defaultdict(int)
+
+    @property
+    def budgeted(self):
+        return self.nodes is not None or self.bytes is not None
+
+    def fit(self):
+        """The lowest threshold from self.threshold up that leaves what was
+        seen since the last reset within budget"""
+        nodes = sum(self.counts.itervalues())
+        size = sum(self.sizes.itervalues())
+        threshold = self.threshold
+        for count in sorted(self.counts):
+            if count >= threshold and ((self.nodes is None or nodes <= self.nodes) and
+                                       (self.bytes is None or size <= self.bytes)):
+                break
+            nodes -= self.counts[count]
+            size -= self.sizes[count]
+            threshold = max(threshold, count + 1)
+        return threshold
+
+    def prune(self, node, threshold, version, store, part=None):
+        """Drop every child of node seen fewer than threshold times, all the
+        way down, and count the nodes seen
+
+        Returns node or, if anything below it changed, a copy of it that
+        version can change.  With part, only the children whose symbol is
+        in that slice are looked at.
+        """
+        kept = []
+        dropped = 0
+        changed = False
+        for child in node.children:
+            if part is not None and child.symbol % self.slices != part:
+                kept.append(child)
+            elif child.count < threshold:
+                nodes, size = child.measure()
+                self.counts[child.count] += nodes
+                self.sizes[child.count] += size
+                self.removed += nodes
+                self.reclaimed += size
+                dropped += child.count
+                store.remove(child)
+                changed = True
+            else:
+                pruned = self.prune(child, threshold, version, store) if child.usage else child
+                self.counts[child.count] += 1
+                self.sizes[child.count] += pruned.footprint()
+                changed = changed or pruned is not child
+                kept.append(pruned)
+        if not changed:
+            return node
+        if node.version != version:
+            node = node.copy(version)
+        node.children = kept or ()
+        node.keys = array('i', [child.symbol for child in kept]) if kept else ()
+        node.totals = None
+        if dropped:
+            node.usage -= dropped
+            store.changed(node)
+        return node
+
+
+class Histogram(object):
+
+    """Count, total and extremes of a series of values, and how many fell
+    between each two powers of two, enough for percentiles within a factor
+    of two"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = self.max = None
+        # exponent e -> values in [2 ** (e - 1), 2 ** e)
+        self.buckets = defaultdict(int)
+
+    def add(self, value):
+        if not self.count or value < self.min:
+            self.min = value
+        if not self.count or value > self.max:
+            self.max = value
+        self.count += 1
+        self.total += value
+        self.buckets[math.frexp(value)[1]] += 1
+
+    def merge(self, other):
+        if other.count:
+            if not self.count or other.min < self.min:
+                self.min = other.min
+            if not self.count or other.max > self.max:
+                self.max = other.max
+            self.count += other.count
+            self.total += other.total
+            for exponent, count in other.buckets.iteritems():
+                self.buckets[exponent] += count
+
+    def percentile(self, fraction):
+        """The top of the bucket holding the value fraction of the way up"""
+        rank = fraction * self.count
+        seen = 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                return min(math.ldexp(1.0, exponent), self.max)
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return {'count': 0}
+        return {'count': self.count, 'mean': self.total / self.count, 'min': self.min, 'max': self.max,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+
+class Stats(object):
+
+    """What a brain has been spending its time on, see MegaHAL.stats"""
+
+    def __init__(self, profile=None, dump=None, file=None):
+        self.profile = profile
+        self.lock = threading.Lock()
+        self.reset()
+        self.stopping = threading.Event()
+        if dump:
+            thread = threading.Thread(target=self.dump_every, args=(dump, file or sys.stderr))
+            thread.daemon = True
+            thread.start()
+
+    def __getstate__(self):
+        # what a worker process counted, sent back with its replies
+        return self.started, self.counts, self.depths, self.surprise, self.times
+
+    def __setstate__(self, state):
+        self.started, self.counts, self.depths, self.surprise, self.times = state
+        self.profile = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+
+    def reset(self):
+        self.started = time()
+        self.counts = defaultdict(int)
+        self.depths = defaultdict(int)
+        self.surprise = Histogram()
+        self.times = defaultdict(Histogram)
+
+    def timed(self, name, function, *args):
+        start = time()
         try:
-            return self.index(word)
-        except ValueError:
+            if self.profile is None:
+                return function(*args)
+            with self.profile(name):
+                return function(*args)
+        finally:
+            self.record(name, time() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.times[name].add(seconds)
+
+    def add(self, name, count=1):
+        with self.lock:
+            self.counts[name] += count
+
+    def searched(self, candidates, empty, duplicates, generating, scoring, depths):
+        with self.lock:
+            counts = self.counts
+            counts['candidates'] += candidates
+            counts['empty'] += empty
+            counts['duplicates'] += duplicates
+            self.times['generate'].add(generating)
+            self.times['score'].add(scoring)
+            for depth, count in depths.iteritems():
+                self.depths[depth] += count
+
+    def replied(self, surprise):
+        with self.lock:
+            if surprise < 0:
+                # nothing was found in time, the fallback was used
+                self.counts['fallbacks'] += 1
+            else:
+                self.surprise.add(surprise)
+
+    def merge(self, other):
+        with self.lock:
+            for name, count in other.counts.iteritems():
+                self.counts[name] += count
+            for depth, count in other.depths.iteritems():
+                self.depths[depth] += count
+            self.surprise.merge(other.surprise)
+            for name, histogram in other.times.iteritems():
+                self.times[name].merge(histogram)
+
+    def report(self, reset=False):
+        with self.lock:
+            report = dict((name, histogram.summary()) for name, histogram in self.times.iteritems())
+            report.update(seconds=time() - self.started, counts=dict(self.counts), depths=dict(self.depths),
+                          surprise=self.surprise.summary())
+            if reset:
+                self.reset()
+        return report
+
+    def dump_every(self, interval, file):
+        while not self.stopping.wait(interval):
+            file.write(json.dumps(self.report(), sort_keys=True) + '\n')
+            file.flush()
+
+    def stop(self):
+        self.stopping.set()
+
+
+class ReplyCache(object):
+
+    """The best replies found for recent keywords, to answer them again at once"""
+
+    def __init__(self, size=1000, top=8, ttl=600.0, age=1000, refill=False, idle=1.0):
+        if top < 1:
+            raise ValueError('A reply cache must keep at least one reply')
+        self.size = size
+        self.top = top
+        self.ttl = ttl
+        self.age = age
+        self.refill = refill
+        self.idle = idle
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        # phrases learned so far, and when a reply was last asked for
+        self.phrases = 0
+        self.asked = 0.0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            # keywords -> (replies best first, when found, self.phrases when the search started)
+            self.entries = LRUCache(self.size)
+            # symbol -> [self.phrases when a phrase with it was last learned,
+            # the keywords of that phrase, and when one with other keywords was]
+            self.touched = {}
+            # keywords asked for more than once -> True
+            self.hot = LRUCache(self.size)
+
+    def fresh(self, keywords, entry):
+        replies, found, phrases = entry
+        return (time() - found < self.ttl and self.phrases - phrases < self.age and
+                all(self.changed(key, keywords) <= phrases for key in keywords))
+
+    def changed(self, key, keywords):
+        # learning the phrase asked, as a bot does before it replies, leaves its replies fresh
+        last = self.touched.get(key)
+        if last is None:
+            return 0
+        return last[2] if last[1] == keywords else last[0]
+
+    def get(self, keywords):
+        """The replies kept for keywords while they are fresh, or None"""
+        keywords = tuple(keywords)
+        with self.lock:
+            self.asked = time()
+            entry = self.entries.get(keywords)
+            if entry is None:
+                return None
+            self.hot[keywords] = True
+            if self.fresh(keywords, entry):
+                return entry[0]
+
+    def put(self, keywords, found, phrases):
+        """Keep the best of the (surprise, reply) pairs found by a search that
+        started when self.phrases was phrases"""
+        replies = []
+        for surprise, reply in sorted(found, reverse=True):
+            if reply and (surprise, reply) not in replies:
+                replies.append((surprise, reply))
+                if len(replies) == self.top:
+                    break
+        if replies:
+            with self.lock:
+                self.entries[tuple(keywords)] = (replies, time(), phrases)
+
+    def learned(self, sentences, lines=1):
+        """Count lines learned, sentences are the keywords and symbols of them"""
+        with self.lock:
+            self.phrases += lines
+            phrases = self.phrases
+            touched = self.touched
+            for keywords, symbols in sentences:
+                for symbol in symbols:
+                    last = touched.get(symbol)
+                    if last is None:
+                        touched[symbol] = [phrases, keywords, 0]
+                    elif last[1] == keywords:
+                        last[0] = phrases
+                    else:
+                        touched[symbol] = [phrases, keywords, last[0]]
+
+    def stale(self):
+        """The hot keywords whose replies are gone or stale"""
+        with self.lock:
+            return [keywords for keywords in self.hot.keys()
+                    if not self.fresh(keywords, self.entries.get(keywords, ((), 0, 0)))]
+
+    def stop(self):
+        self.stopping.set()
+
+
+class Cursor(object):
+
+    """Read-only walk down a trie, at every order following the last symbols
+    of a reply, generating replies never changes the brain
+
+    keys are the keyword symbols of a reply, the cursor is reset and reused
+    for every candidate.
+    """
+
+    def __init__(self, brain, snapshot, keys=()):
+        self.brain = brain
+        # every reply of a cursor comes from the same version of the brain
+        self.snapshot = snapshot
+        self.keys = keys
+        self.nodes = [None] * (brain.order + 2)
+        self.used_key = False
+        # symbols babble prefers, auxiliary words only once another keyword was used
+        auxwords = brain.auxwords
+        dictionary = brain.dictionary
+        self.wanted = set(keys)
+        self.primary = set(key for key in keys if dictionary[key] not in auxwords)
+
+    def reset(self, tree):
+        nodes = self.nodes
+        nodes[0] = tree
+        for i in xrange(1, len(nodes)):
+            nodes[i] = None
+        self.used_key = False
+
+    @property
+    def root(self):
+        return self.nodes[0]
+
+    def update(self, symbol):
+        nodes = self.nodes
+        for i in xrange(len(nodes) - 1, 0, -1):
+            node = nodes[i - 1]
+            if node is not None:
+                node = node.get_child(symbol, add=False)
+            nodes[i] = node
+
+    def seed(self):
+        keys = self.keys
+        if keys:
+            i = random.randrange(len(keys))
+            for key in keys[i:] + keys[:i]:
+                if key in self.primary:
+                    return key
+        # the keys of a mapped root are read in place, its children would all be built
+        roots = self.root.keys
+        if roots:
+            return random.choice(roots)
+        return 0
+
+    def babble(self):
+        """Pick a child of the deepest known context, weighted by count
+
+        This is a bisection of the running totals of the children, giving
+        the same symbol as going round the children from a random one until
+        either the random count runs out or a keyword is passed.
+        """
+        # contexts left without children by pruning back off to shorter ones
+        node = self.nodes[0]
+        for candidate in self.nodes[1:-1]:
+            if candidate is None or not candidate.usage:
+                break
+            node = candidate
+        keys = node.keys
+        if not keys:
             return 0
+        size = len(keys)
+        i = random.randrange(size)
+        count = random.randrange(node.usage)
+        totals = node.cumulative()
+        target = count + totals[i - 1] if i else count
+        if target < totals[-1]:
+            j = bisect_right(totals, target, i)
+        else:
+            j = bisect_right(totals, target - totals[-1])
+        steps = (j - i) % size
+        wanted = self.wanted if self.used_key else self.primary
+        if steps < len(wanted):
+            # fewer children to pass than keywords to look up
+            for k in xrange(i, i + steps + 1):
+                if keys[k % size] in wanted:
+                    self.used_key = True
+                    return keys[k % size]
+            return keys[j]
+        for symbol in wanted:
+            k = node.find(symbol)
+            if k >= 0 and (k - i) % size <= steps:
+                j = k
+                steps = (k - i) % size
+                self.used_key = True
+        return keys[j]
+
+
+class CountingCursor(Cursor):
+
+    """Cursor that also counts how deep the contexts babble picks from are,
+    used only while a brain keeps stats"""
+
+    def __init__(self, brain, snapshot, keys=()):
+        Cursor.__init__(self, brain, snapshot, keys)
+        self.depths = defaultdict(int)
+
+    def babble(self):
+        depth = 0
+        for node in self.nodes[1:-1]:
+            if node is None or not node.usage:
+                break
+            depth += 1
+        self.depths[depth] += 1
+        return Cursor.babble(self)
+
+
+class Snapshot(object):
+
+    """One published version of the tries of a brain, and the probabilities
+    cached for it
+
+    Learning builds the next version beside it, copying the nodes it changes,
+    so replies read the version they started with however long learning takes.
+    """
+
+    __slots__ = ('forward', 'backward', 'probabilities', 'readers')
+
+    def __init__(self, forward, backward, probabilities):
+        self.forward = forward
+        self.backward = backward
+        # (direction, context symbols) -> (node, {symbol: probability})
+        self.probabilities = probabilities
+        # how many are inside Brain.reading with it
+        self.readers = 0
 
 
 class Brain(object):
 
-    def __init__(self, order, file, timeout):
-        self.timeout = timeout
-        self.db = shelve.open(file, writeback=True)
-        if self.db.setdefault('api', API_VERSION) != API_VERSION:
-            raise ValueError('This brain has an incompatible api version: %d != %d' % (self.db['api'], API_VERSION))
-        if self.db.setdefault('order', order) != order:
-            raise ValueError('This brain already has an order of %d' % self.db['order'])
-        self.forward = self.db.setdefault('forward', Tree())
-        self.backward = self.db.setdefault('backward', Tree())
-        self.dictionary = self.db.setdefault('dictionary', Dictionary())
+    # pruning can leave loops with no way to the end of a reply, candidates
+    # running longer than this in either direction are given up on
+    max_length = 1000
+
+    # workers searching for replies have a copy of the brain as it was when
+    # they were forked, they are forked again once it has learned this many
+    # times since, or this many seconds after that if it learned at all
+    pool_generations = 1000
+    pool_seconds = 10.0
+
+    def __init__(self, order, file, budget, processes=None, pruning=None, stats=None, cache=None):
+        self.budget = budget
+        self.processes = processes
+        self.pruning = pruning
+        self.stats = stats
+        self.cache = cache
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()
+        self.generation = self.pool_generation = 0
+        self.pool_started = 0.0
+        # the words the workers know, the dictionary only grows
+        self.pool_words = 0
+        self.store = open_store(file)
+        if self.store.setdefault('api', API_VERSION) != API_VERSION:
+            raise ValueError('This brain has an incompatible api version: %d != %d' % (self.store['api'], API_VERSION))
+        if self.store.setdefault('order', order) != order:
+            raise ValueError('This brain already has an order of %d' % self.store['order'])
+        self.snapshot = Snapshot(self.store.get_tree('forward'), self.store.get_tree('backward'), LRUCache())
+        self.dictionary = self.store.get_dictionary()
         self.error_symbol = self.dictionary.add_word(ERROR_WORD)
         self.end_symbol = self.dictionary.add_word(END_WORD)
-        self.banwords = self.db.setdefault('banwords', Dictionary(DEFAULT_BANWORDS))
-        self.auxwords = self.db.setdefault('auxwords', Dictionary(DEFAULT_AUXWORDS))
-        self.swapwords = self.db.setdefault('swapwords', DEFAULT_SWAPWORDS)
+        self.banwords = self.store.setdefault('banwords', Dictionary(DEFAULT_BANWORDS))
+        self.auxwords = self.store.setdefault('auxwords', Dictionary(DEFAULT_AUXWORDS))
+        self.swapwords = self.store.setdefault('swapwords', DEFAULT_SWAPWORDS)
+        self.readonly = self.store.readonly
         self.closed = False
+        self.refiller = None
+        if cache is not None and cache.refill:
+            self.refiller = threading.Thread(target=self.refill)
+            self.refiller.daemon = True
+            self.refiller.start()
 
     @property
     def order(self):
-        return self.db['order']
+        return self.store['order']
+
+    # the published tries as they are now, what may read them while another
+    # thread learns goes through reading() instead
+    @property
+    def forward(self):
+        return self.snapshot.forward
+
+    @property
+    def backward(self):
+        return self.snapshot.backward
 
     @staticmethod
-    def get_words_from_phrase(phrase):
+    def iter_words_from_phrase(phrase):
+        """Generate the words of phrase, runs of letters (joined by apostrophes),
+        digits or anything else, ending with a punctuation mark"""
         phrase = phrase.upper()
-        words = []
-        if phrase:
-            offset = 0
-
-            def boundary(string, position):
-                if position == 0:
-                    boundary = False
-                elif position == len(string):
-                    boundary = True
-                elif (string[position] == "'" and
-                    string[position - 1].isalpha() and
-                    string[position + 1].isalpha()):
-                    boundary = False
-                elif (position > 1 and
-                    string[position - 1] == "'" and
-                    string[position - 2].isalpha() and
-                    string[position].isalpha()):
-                    boundary = False
-                elif (string[position].isalpha() and
-                    not string[position - 1].isalpha()):
-                    boundary = True
-                elif (not string[position].isalpha() and
-                    string[position - 1].isalpha()):
-                    boundary = True
-                elif string[position].isdigit() != string[position -1].isdigit():
-                    boundary = True
-                else:
-                    boundary = False
-                return boundary
+        kinds = {}
+        for char in set(phrase):
+            if char.isalpha():
+                kinds[char] = 'a'
+            elif char.isdigit():
+                kinds[char] = 'd'
+            elif char == "'":
+                kinds[char] = "'"
+            else:
+                kinds[char] = 'o'
+        word = None
+        for match in WORD_KINDS.finditer(''.join(map(kinds.__getitem__, phrase))):
+            if word is not None:
+                yield word
+            word = phrase[match.start():match.end()]
+        if word is not None:
+            if word[0].isalnum():
+                yield word
+                yield '.'
+            elif word[-1] not in '!.?':
+                yield '.'
+            else:
+                yield word
 
-            while True:
-                if boundary(phrase, offset):
-                    word, phrase = phrase[:offset], phrase[offset:]
-                    words.append(word)
-                    if not phrase:
-                        break
-                    offset = 0
-                else:
-                    offset += 1
-            if words[-1][0].isalnum():
-                words.append('.')
-            elif words[-1][-1] not in '!.?':
-                words[-1] = '.'
-        return words
-
-    def communicate(self, phrase, learn=True, reply=True):
-        words = self.get_words_from_phrase(phrase)
+    @staticmethod
+    def get_words_from_phrase(phrase):
+        return list(Brain.iter_words_from_phrase(phrase))
+
+    def communicate(self, phrase, learn=True, reply=True, budget=None):
+        if not reply and self.stats is None:
+            return self.learn(self.iter_words_from_phrase(phrase))
+        words = self.timed('tokenize', self.get_words_from_phrase, phrase)
         if learn:
-            self.learn(words)
+            self.timed('learn', self.learn, words)
         if reply:
-            return self.get_reply(words)
-
-    def get_context(self, tree):
-
-        class Context(dict):
-
-            def __enter__(context):
-                context.used_key = False
-                context[0] = tree
-                return context
-
-            def __exit__(context, *exc_info):
-                context.update(self.end_symbol)
-
-            @property
-            def root(context):
-                return context[0]
-
-            def update(context, symbol):
-                for i in xrange(self.order + 1, 0, -1):
-                    node = context.get(i - 1)
-                    if node is not None:
-                        context[i] = node.add_symbol(symbol)
-
-            def seed(context, keys):
-                if keys:
-                    i = random.randrange(len(keys))
-                    for key in keys[i:] +  keys[:i]:
-                        if key not in self.auxwords:
-                            try:
-                                return self.dictionary.index(key)
-                            except ValueError:
-                                pass
-                if context.root.children:
-                    return random.choice(context.root.children).symbol
-                return 0
-
-            def babble(context, keys, replies):
-                for i in xrange(self.order + 1):
-                    if context.get(i) is not None:
-                        node = context[i]
-                if not node.children:
-                    return 0
-                i = random.randrange(len(node.children))
-                count = random.randrange(node.usage)
-                symbol = 0
-                while count >= 0:
-                    symbol = node.children[i].symbol
-                    word = self.dictionary[symbol]
-                    if word in keys and (context.used_key or word not in self.auxwords):
-                        context.used_key = True
-                        break
-                    count -= node.children[i].count
-                    if i >= len(node.children) - 1:
-                        i = 0
-                    else:
-                        i = i + 1
-                return symbol
+            return self.timed('reply', self.get_reply, words, budget)
 
-        return Context()
+    def timed(self, name, function, *args):
+        """function(*args), timed as name if the brain keeps stats"""
+        stats = self.stats
+        if stats is None:
+            return function(*args)
+        return stats.timed(name, function, *args)
 
     def learn(self, words):
-        if len(words) > self.order:
-            with self.get_context(self.forward) as context:
-                for word in words:
-                    context.update(self.dictionary.add_word(word))
-            with self.get_context(self.backward) as context:
-                for word in reversed(words):
-                    context.update(self.dictionary.index(word))
-
-    def get_reply(self, words):
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        words = iter(words)
+        head = list(islice(words, self.order + 1))
+        if len(head) > self.order:
+            symbols = array('i', [self.dictionary.add_word(word) for word in chain(head, words)])
+            with self.writing(symbols) as (forward, backward):
+                self.grow(forward, symbols)
+                self.grow(backward, reversed(symbols))
+            self.learned(1, [symbols])
+
+    @contextmanager
+    def writing(self, symbols=None, copy=False):
+        """The roots of the tries to learn into, published as the next version
+        when done, only one thread may be learning at a time
+
+        While a reply reads the published version, or with copy, the roots
+        are copies and every node learning changes is copied on write.
+        Otherwise the tries change in place and replies starting meanwhile
+        wait until they are published, which is only worth it for a phrase.
+        The cached probabilities are kept but for the contexts learning
+        symbols changes, without symbols they are all dropped.
+        """
+        lock = self.snapshot_lock
+        lock.acquire()
+        try:
+            snapshot = self.snapshot
+            probabilities = snapshot.probabilities
+            if copy or snapshot.readers:
+                lock.release()
+                lock = None
+                version = self.generation + 1
+                trees = snapshot.forward.copy(version), snapshot.backward.copy(version)
+                probabilities = probabilities.copy() if symbols is not None else LRUCache()
+            else:
+                trees = snapshot.forward, snapshot.backward
+                if symbols is None:
+                    probabilities.clear()
+            yield trees
+            if symbols is not None:
+                self.forget(probabilities, symbols)
+            if lock is None:
+                self.store.set_tree('forward', trees[0])
+                self.store.set_tree('backward', trees[1])
+                self.snapshot = Snapshot(trees[0], trees[1], probabilities)
+            self.generation += 1
+        finally:
+            if lock is not None:
+                lock.release()
+
+    @contextmanager
+    def reading(self):
+        """The published version of the brain, for a reply to read, learning
+        copies what it changes instead of changing it until the block ends"""
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            snapshot.readers += 1
+        try:
+            yield snapshot
+        finally:
+            with self.snapshot_lock:
+                snapshot.readers -= 1
+
+    def grow(self, tree, symbols):
+        order = self.order
+        context = [tree] + [None] * (order + 1)
+        for symbol in chain(symbols, (self.end_symbol,)):
+            for i in xrange(order + 1, 0, -1):
+                node = context[i - 1]
+                if node is not None:
+                    context[i] = node.add_symbol(symbol)
+
+    def forget(self, cache, symbols):
+        """Drop the cached probabilities of every context that learning symbols changed"""
+        if cache:
+            for direction, sequence in enumerate((symbols, symbols[::-1])):
+                sequence = tuple(sequence) + (self.end_symbol,)
+                for end in xrange(len(sequence) + 1):
+                    for start in xrange(max(0, end - self.order + 1), end + 1):
+                        cache.discard((direction, sequence[start:end]))
+
+    def count_ngrams(self, counts, symbols):
+        """Count the nodes grow would add symbols to, keyed by their path from the root"""
+        symbols = tuple(symbols) + (self.end_symbol,)
+        width = self.order + 1
+        for end in xrange(1, len(symbols) + 1):
+            for start in xrange(max(0, end - width), end):
+                counts[symbols[start:end]] += 1
+
+    def train(self, lines, batch=10000, processes=None, progress=None):
+        """Learn every line, batch lines at a time
+
+        A batch only counts the n-grams every line adds to the tries, they
+        are merged into the brain afterwards, so each changed node is found
+        and stored once per batch instead of once per line.  With processes,
+        lines are tokenized by a pool of workers.  progress is called after
+        every batch with the number of lines done so far and the number of
+        lines per second.
+        """
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        # nothing learned is garbage, so collecting while millions of nodes
+        # are allocated is wasted time
+        collect = gc.isenabled()
+        gc.disable()
+        pool = None
+        if processes:
+            pool = multiprocessing.Pool(processes)
+            sentences = pool.imap(tokenize_worker, lines, 256)
+        else:
+            sentences = imap(self.get_words_from_phrase, lines)
+        try:
+            order = self.order
+            add_word = self.dictionary.add_word
+            forward, backward = defaultdict(int), defaultdict(int)
+            # the symbols of every line of the batch, if cached replies need them
+            caching = self.cache is not None
+            learned = []
+            stats = self.stats
+            done = 0
+            start = batch_start = time()
+            for done, words in enumerate(sentences, 1):
+                if len(words) > order:
+                    symbols = [add_word(word) for word in words]
+                    self.count_ngrams(forward, symbols)
+                    if caching:
+                        learned.append(symbols[:])
+                    symbols.reverse()
+                    self.count_ngrams(backward, symbols)
+                if not done % batch:
+                    self.absorb(forward, backward)
+                    self.learned(batch, learned)
+                    forward, backward = defaultdict(int), defaultdict(int)
+                    learned = []
+                    if stats is not None:
+                        stats.record('train', time() - batch_start)
+                        batch_start = time()
+                    if progress is not None:
+                        progress(done, done / max(time() - start, 1e-6))
+            self.absorb(forward, backward)
+            self.learned(done % batch, learned)
+            if stats is not None:
+                if done % batch:
+                    stats.record('train', time() - batch_start)
+                stats.add('trained', done)
+            if progress is not None and done % batch:
+                progress(done, done / max(time() - start, 1e-6))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if collect:
+                gc.enable()
+        return done
+
+    def absorb(self, forward, backward):
+        if forward or backward:
+            with self.writing(copy=True) as trees:
+                for tree, counts in zip(trees, (forward, backward)):
+                    # sorted paths visit the trie depth first, parents before children
+                    path = [tree]
+                    for ngram in sorted(counts):
+                        del path[len(ngram):]
+                        path.append(path[-1].add_symbol(ngram[-1], counts[ngram]))
+            if self.store.incremental:
+                self.sync()
+
+    def learned(self, lines, sentences=()):
+        """Make cached replies stale by the symbols of the sentences learned, and
+        prune the next slice of the tries for every pruning.every lines learned"""
+        cache = self.cache
+        if cache is not None:
+            dictionary = self.dictionary
+            cache.learned([(tuple(self.make_keywords([dictionary[symbol] for symbol in symbols])), symbols)
+                           for symbols in sentences], lines)
+        pruning = self.pruning
+        if pruning is not None:
+            pruning.learned += lines
+            while pruning.learned >= pruning.every:
+                pruning.learned -= pruning.every
+                self.sweep()
+
+    def sweep(self):
+        pruning = self.pruning
+        if not pruning.slice:
+            pruning.reset()
+        with self.writing(copy=True) as trees:
+            for tree in trees:
+                pruning.prune(tree, pruning.current, tree.version, self.store, pruning.slice)
+        pruning.slice = (pruning.slice + 1) % pruning.slices
+        if not pruning.slice and pruning.budgeted:
+            pruning.current = pruning.fit()
+
+    def prune(self, pruning):
+        """Prune both tries at once as pruning says, returns the threshold used
+
+        This reads the whole brain, and with a budget it does so twice.
+        """
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        threshold = pruning.threshold
+        if pruning.budgeted:
+            pruning.reset()
+            with self.reading() as snapshot:
+                for tree in snapshot.forward, snapshot.backward:
+                    pruning.prune(tree, 0, None, self.store)
+            threshold = pruning.fit()
+        pruning.reset()
+        with self.writing(copy=True) as trees:
+            for tree in trees:
+                pruning.prune(tree, threshold, tree.version, self.store)
+        if self.store.incremental:
+            self.sync()
+        return threshold
+
+    def compact(self):
+        """Renumber the dictionary without the words no trie uses any more,
+        keeping the order of the rest, returns how many words were dropped
+
+        Symbols change under replies in progress, so this is for when
+        nothing else is using the brain.
+        """
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        if self.store.incremental:
+            self.sync()
+        with self.snapshot_lock:
+            snapshot = self.snapshot
+            used = array('b', [0]) * len(self.dictionary)
+            used[self.error_symbol] = used[self.end_symbol] = 1
+            stack = [snapshot.forward, snapshot.backward]
+            while stack:
+                node = stack.pop()
+                used[node.symbol] = 1
+                stack.extend(node.children)
+            symbols = array('i', [-1]) * len(used)
+            words = []
+            for symbol, word in enumerate(self.dictionary):
+                if used[symbol]:
+                    symbols[symbol] = len(words)
+                    words.append(word)
+            dropped = len(self.dictionary) - len(words)
+            if dropped:
+                stack = [snapshot.forward, snapshot.backward]
+                while stack:
+                    node = stack.pop()
+                    node.symbol = symbols[node.symbol]
+                    if node.children:
+                        node.keys = array('i', [symbols[key] for key in node.keys])
+                        stack.extend(node.children)
+                self.dictionary[:] = words
+                self.error_symbol = symbols[self.error_symbol]
+                self.end_symbol = symbols[self.end_symbol]
+                self.store.renumber(symbols, self.dictionary)
+                # cached probabilities and replies and forked workers know the old symbols
+                self.snapshot = Snapshot(snapshot.forward, snapshot.backward, LRUCache())
+                self.generation += 1
+                if self.cache is not None:
+                    self.cache.clear()
+                self.close_pool()
+        return dropped
+
+    def train_shards(self, lines, batch=10000, processes=None, progress=None):
+        """Learn every line, handing batch lines at a time to a pool of workers
+
+        Each worker trains a brain of its own in memory on its slice of the
+        lines, the shards are merged into this brain in the order of their
+        slices, so the result is the same as learning the lines one by one.
+        """
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        processes = processes or multiprocessing.cpu_count()
+        collect = gc.isenabled()
+        gc.disable()
+        pool = multiprocessing.Pool(processes)
+        try:
+            order = self.order
+            # keep a few slices queued per worker, instead of the whole corpus
+            pending = deque()
+            done = 0
+            start = time()
+            while True:
+                while len(pending) < 2 * processes:
+                    chunk = list(islice(lines, batch))
+                    if not chunk:
+                        break
+                    pending.append(pool.apply_async(shard_worker, ((order, chunk),)))
+                if not pending:
+                    break
+                count, dictionary, forward, backward = pending.popleft().get()
+                self.merge(dictionary, forward, backward)
+                done += count
+                if progress is not None:
+                    progress(done, done / max(time() - start, 1e-6))
+        finally:
+            pool.terminate()
+            pool.join()
+            if collect:
+                gc.enable()
+        return done
+
+    def merge(self, dictionary, forward, backward):
+        """Add the counts of the tries of another brain, whose symbols index dictionary"""
+        if self.readonly:
+            raise ValueError('This brain is read-only')
+        symbols = array('i', [self.dictionary.add_word(word) for word in dictionary])
+        with self.writing(copy=True) as trees:
+            trees[0].merge(forward, symbols)
+            trees[1].merge(backward, symbols)
+        if self.cache is not None:
+            self.cache.learned([(None, symbols)], 0)
+        if self.store.incremental:
+            self.sync()
+
+    def merge_brain(self, file):
+        """Add the counts of the brain in file, which must have the same order"""
+        if not whichdb(file) and not os.path.isfile(file):
+            raise ValueError('%s does not exist' % file)
+        try:
+            store = open_store(file, readonly=True)
+        except sqlite3.DatabaseError:
+            raise ValueError('%s is not a brain' % file)
+        try:
+            try:
+                order = store['order']
+            except (KeyError, sqlite3.DatabaseError):
+                raise ValueError('%s is not a brain' % file)
+            if order != self.order:
+                raise ValueError('%s has an order of %d, not %d' % (file, store['order'], self.order))
+            self.merge(store.get_dictionary(), store.get_tree('forward'), store.get_tree('backward'))
+        finally:
+            store.close()
+
+    def get_reply(self, words, budget=None):
+        return self.wait_reply(*self.start_reply(words, budget))
+
+    def start_reply(self, words, budget=None):
+        """Start looking for a reply to words, worker processes keep searching
+        in the background, returns what wait_reply needs to pick the reply"""
+        if budget is None:
+            budget = self.budget
         keywords = self.make_keywords(words)
-        dummy_reply = self.generate_replywords()
-        if not dummy_reply or words == dummy_reply:
-            output = self.get_words_from_phrase("I don't know enough to answer yet!")
+        cache = self.cache
+        top = 1
+        if cache is not None:
+            replies = self.cached_replies(keywords)
+            if replies is not None:
+                # any of the best found before, so the same phrase still gets different replies
+                return None, [random.choice(replies)]
+            top = cache.top
+            phrases = cache.phrases
+        output = self.make_fallback(words)
+
+        if self.processes:
+            budget = budget.share(self.processes)
+            pool, known = self.get_pool()
+            # words learned since the workers were forked are not keywords to them
+            jobs = [([key for key in keywords if key < known], budget, random.getrandbits(32), top)
+                    for i in xrange(self.processes)]
+            callback = None
+            if cache is not None:
+                def callback(results):
+                    cache.put(keywords, [pair for found, stats in results for pair in found], phrases)
+            results = pool.map_async(search_worker, jobs, callback=callback)
         else:
-            output = dummy_reply
+            results = self.search(keywords, budget, top)
+            if cache is not None:
+                cache.put(keywords, results, phrases)
+        return output, results
+
+    def cached_replies(self, keywords):
+        replies = self.cache.get(keywords)
+        if self.stats is not None:
+            self.stats.add('cache_misses' if replies is None else 'cache_hits')
+        return replies
+
+    def make_fallback(self, words):
+        """The words to answer with if no reply is found in time"""
+        with self.reading() as snapshot:
+            dummy_reply = self.generate_reply(Cursor(self, snapshot))
+        if not dummy_reply or [self.dictionary.find_word(word) for word in words] == dummy_reply:
+            return self.get_words_from_phrase("I don't know enough to answer yet!")
+        return [self.dictionary[symbol] for symbol in dummy_reply]
+
+    def get_replies(self, phrases, learn=True, budget=None):
+        """Reply to every phrase, learning them all first if learn is set
+
+        budget is shared by the whole batch, see search_many, phrases with
+        replies in the reply cache are answered from it.
+        """
+        if budget is None:
+            budget = self.budget
+        sentences = [self.timed('tokenize', self.get_words_from_phrase, phrase) for phrase in phrases]
+        if learn:
+            for words in sentences:
+                self.timed('learn', self.learn, words)
+        keywords = [self.make_keywords(words) for words in sentences]
+        cached = [None] * len(sentences)
+        if self.cache is not None:
+            cached = [self.cached_replies(keys) for keys in keywords]
+            sentences = [words for words, replies in zip(sentences, cached) if replies is None]
+            keywords = [keys for keys, replies in zip(keywords, cached) if replies is None]
+        outputs = [self.make_fallback(words) for words in sentences]
 
+        if not keywords:
+            results = []
+        elif self.processes:
+            budget = budget.share(self.processes)
+            pool, known = self.get_pool()
+            known = [[key for key in keys if key < known] for keys in keywords]
+            jobs = [(known, budget, random.getrandbits(32)) for i in xrange(self.processes)]
+            try:
+                results = self.gather(pool.map_async(search_many_worker, jobs).get(0xffff))
+            except multiprocessing.TimeoutError:
+                results = []
+        else:
+            results = [self.search_many(keywords, budget)]
+        searched = iter([self.wait_reply(output, [found[i] for found in results]) for i, output in enumerate(outputs)])
+        return [next(searched) if replies is None else self.wait_reply(None, [random.choice(replies)])
+                for replies in cached]
+
+    def wait_reply(self, output, results, timeout=0xffff):
+        """Pick the best reply found, output is kept if the workers take longer than timeout"""
+        if not isinstance(results, list):
+            try:
+                # waiting with a timeout keeps ^C working
+                results = [pair for found in self.gather(results.get(timeout)) for pair in found]
+            except multiprocessing.TimeoutError:
+                results = []
         max_surprise = -1.0
-        basetime = time()
-        while time() - basetime < self.timeout:
-            reply = self.generate_replywords(keywords)
-            surprise = self.evaluate_reply(keywords, reply)
-            if reply and surprise > max_surprise and reply != keywords:
+        for surprise, reply in results:
+            if reply and surprise > max_surprise:
                 max_surprise = surprise
-                output = reply
+                output = [self.dictionary[symbol] for symbol in reply]
+        if self.stats is not None:
+            self.stats.replied(max_surprise)
 
         return ''.join(output).capitalize()
 
-    def evaluate_reply(self, keys, words):
-        state = {'num': 0, 'entropy': 0.0}
-        if words:
-
-            def evaluate(node, words):
-                with self.get_context(node) as context:
-                    for word in words:
-                        symbol = self.dictionary.index(word)
-                        context.update(symbol)
-                        if word in keys:
-                            prob = 0.0
-                            count = 0
-                            state['num'] += 1
-                            for j in xrange(self.order):
-                                node = context.get(j)
-                                if node is not None:
-                                    child = node.get_child(symbol, add=False)
-                                    if child:
-                                        prob += float(child.count) / node.usage
-                                    count += 1
-                            if count:
-                                state['entropy'] -= math.log(prob / count)
-
-            evaluate(self.forward, words)
-            evaluate(self.backward, reversed(words))
-
-            if state['num'] >= 8:
-                state['entropy'] /= math.sqrt(state['num'] - 1)
-            if state['num'] >= 16:
-                state['entropy'] /= state['num']
-        return state['entropy']
-
-    def generate_replywords(self, keys=None):
-        if keys is None:
-            keys = []
-        replies = []
-        with self.get_context(self.forward) as context:
-            start = True
-            while True:
-                if start:
-                    symbol = context.seed(keys)
-                    start = False
+    def gather(self, results):
+        """What each worker found, adding what they counted to the stats"""
+        found = []
+        for result, stats in results:
+            if stats is not None and self.stats is not None:
+                self.stats.merge(stats)
+            found.append(result)
+        return found
+
+    def search(self, keywords, budget, top=1):
+        """Generate and score replies until budget runs out, all in symbols,
+        returns the (surprise, reply) of the best top replies, best first"""
+        budget = budget.share()
+        with self.reading() as snapshot:
+            stats = self.stats
+            if stats is None:
+                cursor = Cursor(self, snapshot, keywords)
+            else:
+                cursor = CountingCursor(self, snapshot, keywords)
+                seen = set()
+                empty = duplicates = 0
+                generating = scoring = 0.0
+            keys = cursor.wanted
+            max_surprise = -1.0
+            output = None
+            # a heap of the best top replies, when more than the best is wanted
+            kept = []
+            tries = stalled = 0
+            while not budget.exhausted(tries, stalled, max_surprise):
+                if stats is not None:
+                    start = time()
+                reply = self.generate_reply(cursor)
+                if stats is not None:
+                    generated = time()
+                    generating += generated - start
+                surprise = self.evaluate_reply(keys, reply, cursor.snapshot)
+                if stats is not None:
+                    scoring += time() - generated
+                    if not reply:
+                        empty += 1
+                    elif tuple(reply) in seen:
+                        duplicates += 1
+                    else:
+                        seen.add(tuple(reply))
+                tries += 1
+                if (top > 1 and reply and reply != keywords and (len(kept) < top or surprise > kept[0][0]) and
+                    (surprise, reply) not in kept):
+                    if len(kept) < top:
+                        heapq.heappush(kept, (surprise, reply))
+                    else:
+                        heapq.heapreplace(kept, (surprise, reply))
+                if reply and surprise > max_surprise and reply != keywords:
+                    max_surprise = surprise
+                    output = reply
+                    stalled = 0
                 else:
-                    symbol = context.babble(keys, replies)
-                if symbol in (self.error_symbol, self.end_symbol):
-                    break
-                replies.append(self.dictionary[symbol])
-                context.update(symbol)
-        with self.get_context(self.backward) as context:
-            if replies:
-                for i in xrange(min([(len(replies) - 1), self.order]), -1, -1):
-                    context.update(self.dictionary.index(replies[i]))
-            while True:
-                symbol = context.babble(keys, replies)
-                if symbol in (self.error_symbol, self.end_symbol):
+                    stalled += 1
+            if stats is not None:
+                stats.searched(tries, empty, duplicates, generating, scoring, cursor.depths)
+            if top > 1:
+                return sorted(kept, reverse=True)
+            return [(max_surprise, output)] if output is not None else []
+
+    def search_many(self, keywords, budget):
+        """search for every list of keywords at once, returns the best
+        (surprise, reply) for each
+
+        Lists of the same keywords share a cursor, and every candidate is
+        scored (and counted) for each list it has a keyword of, so lists with
+        keywords in common share their candidates.  The candidates of budget
+        are split between the lists, which take turns until each is
+        exhausted.
+        """
+        budget = budget.share()
+        with self.reading() as snapshot:
+            groups = {}
+            for keys in keywords:
+                groups.setdefault(tuple(keys), len(groups))
+            each = budget.share(len(groups))
+            cursors = [None] * len(groups)
+            stats = self.stats
+            # keyword symbol -> the groups it is a keyword of
+            index = defaultdict(list)
+            for keys, group in groups.iteritems():
+                cursors[group] = (Cursor(self, snapshot, list(keys)) if stats is None else
+                                  CountingCursor(self, snapshot, list(keys)))
+                for key in cursors[group].wanted:
+                    index[key].append(group)
+            if stats is not None:
+                seen = set()
+                candidates = empty = duplicates = 0
+                generating = scoring = 0.0
+            surprises = [-1.0] * len(groups)
+            outputs = [None] * len(groups)
+            tries = [0] * len(groups)
+            stalled = [0] * len(groups)
+            active = range(len(groups))
+            while active:
+                for group in active:
+                    cursor = cursors[group]
+                    if stats is not None:
+                        start = time()
+                    reply = self.generate_reply(cursor)
+                    if stats is not None:
+                        generated = time()
+                        generating += generated - start
+                        candidates += 1
+                        if not reply:
+                            empty += 1
+                        elif tuple(reply) in seen:
+                            duplicates += 1
+                        else:
+                            seen.add(tuple(reply))
+                    scored = set([group])
+                    for symbol in set(reply):
+                        scored.update(index.get(symbol, ()))
+                    for other in scored:
+                        keys = cursors[other].keys
+                        surprise = self.evaluate_reply(cursors[other].wanted, reply, cursor.snapshot)
+                        tries[other] += 1
+                        if reply and surprise > surprises[other] and reply != keys:
+                            surprises[other] = surprise
+                            outputs[other] = reply
+                            stalled[other] = 0
+                        else:
+                            stalled[other] += 1
+                    if stats is not None:
+                        scoring += time() - generated
+                active = [group for group in active
+                          if not each.exhausted(tries[group], stalled[group], surprises[group])]
+            if stats is not None:
+                depths = defaultdict(int)
+                for cursor in cursors:
+                    for depth, count in cursor.depths.iteritems():
+                        depths[depth] += count
+                stats.searched(candidates, empty, duplicates, generating, scoring, depths)
+            return [(surprises[groups[tuple(keys)]], outputs[groups[tuple(keys)]]) for keys in keywords]
+
+    def refill(self):
+        """Search again for the hot keywords of the reply cache whose replies
+        went stale, while no reply has been asked for in cache.idle seconds"""
+        cache = self.cache
+        while not cache.stopping.wait(cache.idle):
+            for keywords in cache.stale():
+                if cache.stopping.is_set() or time() - cache.asked < cache.idle:
                     break
-                replies.insert(0, self.dictionary[symbol])
-                context.update(symbol)
+                phrases = cache.phrases
+                try:
+                    cache.put(keywords, self.search(list(keywords), self.budget, cache.top), phrases)
+                except Exception:
+                    # the thread has to outlive any one search
+                    traceback.print_exc()
+
+    def get_pool(self):
+        """The pool of workers and how many words they know, see pool_generations"""
+        with self.pool_lock:
+            learned = self.generation - self.pool_generation
+            if (self.pool is not None and learned and
+                (learned >= self.pool_generations or time() - self.pool_started >= self.pool_seconds)):
+                # the old workers finish the searches they were given first
+                self.pool.close()
+                joiner = threading.Thread(target=self.pool.join)
+                joiner.daemon = True
+                joiner.start()
+                self.pool = None
+            if self.pool is None:
+                self.pool_generation = self.generation
+                self.pool_started = time()
+                self.pool_words = len(self.dictionary)
+                self.pool = multiprocessing.Pool(self.processes, init_worker, (self,))
+            return self.pool, self.pool_words
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def evaluate_reply(self, keys, symbols, snapshot=None):
+        if snapshot is None:
+            with self.reading() as snapshot:
+                return self.evaluate_reply(keys, symbols, snapshot)
+        num = 0
+        entropy = 0.0
+        if symbols:
+            width = self.order - 1
+            for direction in 0, 1:
+                if direction:
+                    symbols = symbols[::-1]
+                for i, symbol in enumerate(symbols):
+                    if symbol in keys:
+                        num += 1
+                        prob, count = self.get_probability(direction, symbols[max(0, i + 1 - width):i + 1],
+                                                           symbol, snapshot)
+                        # pruning can leave a symbol in no context at all
+                        if prob:
+                            entropy -= math.log(prob / count)
+
+            if num >= 8:
+                entropy /= math.sqrt(num - 1)
+            if num >= 16:
+                entropy /= num
+        return entropy
+
+    def get_probability(self, direction, context, symbol, snapshot=None):
+        """Sum the probabilities of symbol following each suffix of context,
+        returns the sum and the number of suffixes found in the trie"""
+        if snapshot is None:
+            with self.reading() as snapshot:
+                return self.get_probability(direction, context, symbol, snapshot)
+        cache = snapshot.probabilities
+        tree = snapshot.backward if direction else snapshot.forward
+        prob = 0.0
+        count = 0
+        for start in xrange(len(context), -1, -1):
+            suffix = tuple(context[start:])
+            entry = cache.get((direction, suffix))
+            if entry is None:
+                node = tree
+                for key in suffix:
+                    node = node.get_child(key, add=False)
+                    if node is None:
+                        break
+                entry = cache[direction, suffix] = (node, {})
+            node, probs = entry
+            if node is None:
+                break
+            try:
+                prob += probs[symbol]
+            except KeyError:
+                child = node.get_child(symbol, add=False)
+                probs[symbol] = float(child.count) / node.usage if child else 0.0
+                prob += probs[symbol]
+            count += 1
+        return prob, count
+
+    def generate_reply(self, cursor):
+        """Babble forwards from a keyword and then backwards to the start, as symbols"""
+        stop = (self.error_symbol, self.end_symbol)
+        replies = []
+        cursor.reset(cursor.snapshot.forward)
+        symbol = cursor.seed()
+        while symbol not in stop:
+            if len(replies) == self.max_length:
+                return []
+            replies.append(symbol)
+            cursor.update(symbol)
+            symbol = cursor.babble()
+        cursor.reset(cursor.snapshot.backward)
+        if replies:
+            for i in xrange(min([(len(replies) - 1), self.order]), -1, -1):
+                cursor.update(replies[i])
+        symbol = cursor.babble()
+        if symbol not in stop:
+            prefix = []
+            while symbol not in stop:
+                if len(prefix) == self.max_length:
+                    return []
+                prefix.append(symbol)
+                cursor.update(symbol)
+                symbol = cursor.babble()
+            prefix.reverse()
+            replies[:0] = prefix
 
         return replies
 
     def make_keywords(self, words):
+        """Pick the keyword symbols of words, auxiliary words only come after
+        the others and only if there are any"""
         keys = Dictionary()
         for word in words:
             try:
@@ -379,7 +2425,7 @@ class Brain(object):
                     word in self.auxwords and word not in keys):
                     keys.append(word)
 
-        return keys
+        return [self.dictionary.find_word(word) for word in keys]
 
     def add_key(self, keys, word):
         if (self.dictionary.find_word(word) != self.error_symbol and
@@ -387,13 +2433,26 @@ class Brain(object):
             self.auxwords.find_word(word) == self.error_symbol):
             keys.add_word(word)
 
+    def export(self, file):
+        meta = dict((key, self.store[key]) for key in ('api', 'order', 'banwords', 'auxwords', 'swapwords'))
+        with self.reading() as snapshot:
+            MappedStore.write(file, meta, snapshot.forward, snapshot.backward, self.dictionary)
+
     def sync(self):
-        self.db.sync()
+        self.timed('sync', self.store.sync)
 
     def close(self):
         if not self.closed:
             print 'Closing database'
-            self.db.close()
+            if self.stats is not None:
+                self.stats.stop()
+            if self.cache is not None:
+                self.cache.stop()
+            if self.refiller is not None:
+                # a search still going would read the store once it is closed
+                self.refiller.join()
+            self.close_pool()
+            self.store.close()
             self.closed = True
 
     def __del__(self):
@@ -403,16 +2462,251 @@ class Brain(object):
             pass
 
 
+_worker_brain = None
+
+
+def init_worker(brain):
+    global _worker_brain
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    brain.store.after_fork()
+    # another thread of the parent may have held these while it forked
+    brain.snapshot_lock = threading.Lock()
+    brain.pool_lock = threading.Lock()
+    _worker_brain = brain
+
+
+def tokenize_worker(line):
+    return Brain.get_words_from_phrase(line)
+
+
+def shard_worker(job):
+    order, lines = job
+    brain = Brain(order, None, Budget())
+    count = brain.train(lines, len(lines))
+    # an in-memory brain has nothing to close
+    brain.closed = True
+    return count, brain.dictionary, brain.forward, brain.backward
+
+
+def search_worker(job):
+    keywords, budget, seed, top = job
+    random.seed(seed)
+    brain = _worker_brain
+    if brain.stats is not None:
+        # counted afresh for every job and added to the stats of the parent
+        brain.stats = Stats()
+    return brain.search(keywords, budget, top), brain.stats
+
+
+def search_many_worker(job):
+    keywords, budget, seed = job
+    random.seed(seed)
+    brain = _worker_brain
+    if brain.stats is not None:
+        brain.stats = Stats()
+    return brain.search_many(keywords, budget), brain.stats
+
+
+class Busy(ValueError):
+
+    """Raised by Server.call when too many requests are waiting"""
+
+
+class Server(object):
+
+    """Serve one brain to many clients at once, over lines of text and HTTP"""
+
+    # how much longer than its budget a client waits for the workers
+    grace = 1.0
+    # the longest timeout a client may ask for when the brain has none
+    max_timeout = 60.0
+
+    def __init__(self, brain, address=None, http=None, pending=64, batch=1000, interval=1.0):
+        self.brain = brain
+        self.batch = batch
+        self.interval = interval
+        self.slots = threading.BoundedSemaphore(pending)
+        self.learning = Queue.Queue(4 * batch)
+        self.thread = threading.Thread(target=self.run)
+        # stop waits for it, but a second ^C must still be able to exit
+        self.thread.daemon = True
+        self.servers = []
+        if address is not None:
+            self.servers.append(LineServer(address, LineHandler, self))
+        if http is not None:
+            self.servers.append(JSONServer(http, JSONHandler, self))
+
+    @property
+    def addresses(self):
+        return [server.server_address for server in self.servers]
+
+    def start(self):
+        self.thread.start()
+        for server in self.servers:
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stop listening and learn whatever is still waiting"""
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.learning.put(None)
+        self.thread.join()
+
+    def call(self, kind, text, timeout=None):
+        """Handle one request, returns the reply or '' for learn"""
+        if kind not in ('learn', 'reply', 'chat'):
+            raise ValueError('Unknown command: %s' % kind)
+        brain = self.brain
+        if kind == 'learn' and brain.readonly:
+            raise ValueError('This brain is read-only')
+        budget = brain.budget
+        if timeout is not None:
+            timeout = float(timeout)
+            # nan is neither
+            if not 0 < timeout < float('inf'):
+                raise ValueError('A timeout must be a positive number of seconds')
+            # clients may ask for less time than the brain's own timeout, not more
+            budget = Budget(min(timeout, budget.timeout or self.max_timeout), budget.candidates, budget.surprise,
+                            budget.stall)
+        if not self.slots.acquire(False):
+            raise Busy('The server is busy')
+        try:
+            if kind != 'reply' and not brain.readonly:
+                try:
+                    self.learning.put_nowait(text)
+                except Queue.Full:
+                    raise Busy('The server is busy')
+            if kind == 'learn':
+                return ''
+            return brain.timed('reply', self.reply, brain.timed('tokenize', brain.get_words_from_phrase, text),
+                               budget.share())
+        finally:
+            self.slots.release()
+
+    def reply(self, words, budget):
+        output, results = self.brain.start_reply(words, budget)
+        wait = 0xffff
+        if budget.deadline is not None:
+            wait = max(0, budget.deadline - time()) + self.grace
+        return self.brain.wait_reply(output, results, wait)
+
+    def run(self):
+        brain = self.brain
+        stopping = False
+        while not stopping:
+            text = self.learning.get()
+            if text is None:
+                break
+            lines = [text]
+            flush = time() + self.interval
+            while len(lines) < self.batch:
+                try:
+                    text = self.learning.get(True, max(0, flush - time()))
+                except Queue.Empty:
+                    break
+                if text is None:
+                    stopping = True
+                    break
+                lines.append(text)
+            try:
+                brain.train(lines, self.batch)
+            except Exception:
+                # the learning thread has to outlive any one batch
+                traceback.print_exc()
+
+
+class LineServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, backend):
+        SocketServer.TCPServer.__init__(self, address, handler)
+        self.backend = backend
+
+
+class JSONServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, handler, backend):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.backend = backend
+
+
+class LineHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.strip()
+            if not line:
+                continue
+            command, _, text = line.partition(' ')
+            command, _, timeout = command.partition('@')
+            try:
+                reply = self.server.backend.call(command.lower(), text.strip(), timeout or None)
+            except ValueError, error:
+                self.wfile.write('ERROR %s\n' % error)
+            else:
+                # learned text may hold line breaks, a reply is still one line
+                self.wfile.write(('OK %s' % ' '.join(reply.splitlines())).rstrip() + '\n')
+
+
+class JSONHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length') or 0)) or '{}')
+            if not isinstance(request, dict):
+                raise ValueError('Expected a JSON object')
+            text = request.get('text', u'')
+            if not isinstance(text, basestring):
+                raise ValueError('Expected text to be a string')
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            timeout = request.get('timeout')
+            if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, long, float))):
+                raise ValueError('Expected timeout to be a number')
+            reply = self.server.backend.call(self.path.strip('/'), text, timeout)
+        except Busy, error:
+            self.answer(503, {'error': str(error)})
+        except ValueError, error:
+            self.answer(400, {'error': str(error)})
+        else:
+            self.answer(200, {'reply': reply.decode('utf-8', 'replace')})
+
+    def answer(self, status, result):
+        body = json.dumps(result)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
 class MegaHAL(object):
 
-    def __init__(self, order=None, brainfile=None, timeout=None):
+    def __init__(self, order=None, brainfile=None, timeout=None, processes=None, candidates=None, surprise=None,
+                 stall=None, pruning=None, stats=None, cache=None):
         if order is None:
             order = DEFAULT_ORDER
         if brainfile is None:
             brainfile = DEFAULT_BRAINFILE
         if timeout is None:
             timeout = DEFAULT_TIMEOUT
-        self.__brain = Brain(order, brainfile, timeout)
+        if stats is True:
+            stats = Stats()
+        if cache is True:
+            cache = ReplyCache()
+        budget = Budget(timeout, candidates, surprise, stall)
+        self.__brain = Brain(order, brainfile, budget, processes, pruning, stats, cache)
 
     @property
     def banwords(self):
@@ -429,35 +2723,88 @@ class MegaHAL(object):
         """The word on the left is changed to the word on the right when used as a keyword"""
         return self.__brain.swapwords
 
-    def train(self, file):
-        """Train the brain with textfile, each line is a phrase"""
-        with open(file, 'rb') as fp:
-            for line in fp:
-                line = line.strip()
-                if line and not line.startswith('#'):
-                    self.learn(line)
+    def train(self, file, batch=10000, processes=None, progress=None, shards=False):
+        """Train the brain with a textfile or iterable of lines, returns the number of lines learned"""
+        if isinstance(file, basestring):
+            with open(file, 'rb') as fp:
+                return self.train(fp, batch, processes, progress, shards)
+        lines = (line.strip() for line in file)
+        lines = (line for line in lines if line and not line.startswith('#'))
+        if shards:
+            return self.__brain.train_shards(lines, batch, processes, progress)
+        return self.__brain.train(lines, batch, processes, progress)
+
+    def merge(self, brainfile):
+        """Add everything learned by the brain in brainfile to this one"""
+        self.__brain.merge_brain(brainfile)
+
+    def prune(self, threshold=2, nodes=None, bytes=None, compact=False):
+        """Drop the n-grams seen fewer than threshold times or to fit a budget, see Pruning"""
+        pruning = Pruning(threshold, nodes, bytes)
+        threshold = self.__brain.prune(pruning)
+        words = self.__brain.compact() if compact else 0
+        return {'threshold': threshold, 'nodes': pruning.removed, 'bytes': pruning.reclaimed, 'words': words}
 
     def learn(self, phrase):
         """Learn from phrase"""
         self.__brain.communicate(phrase, reply=False)
 
-    def get_reply(self, phrase):
-        """Get a reply based on the phrase"""
-        return self.__brain.communicate(phrase)
+    def get_reply(self, phrase, budget=None):
+        """Get a reply based on the phrase, budget overrides the default Budget"""
+        return self.__brain.communicate(phrase, budget=budget)
 
-    def get_reply_nolearn(self, phrase):
+    def get_reply_nolearn(self, phrase, budget=None):
         """Get a reply without updating the database"""
-        return self.__brain.communicate(phrase, learn=False)
+        return self.__brain.communicate(phrase, learn=False, budget=budget)
+
+    def get_replies(self, phrases, budget=None, learn=True):
+        """Get a reply to each of phrases, budget is for all of them and is
+        shared between phrases with keywords in common"""
+        return self.__brain.get_replies(phrases, learn, budget)
+
+    def stats(self, reset=False):
+        """What the brain has been spending its time on as a dict, empty without stats"""
+        stats = self.__brain.stats
+        if stats is None:
+            return {}
+        return stats.report(reset)
+
+    @property
+    def readonly(self):
+        """Exported brains can reply but not learn"""
+        return self.__brain.readonly
 
     def interact(self):
         """Have a friendly chat session.. ^D to exit"""
+        get_reply = self.get_reply_nolearn if self.readonly else self.get_reply
         while True:
             try:
                 phrase = raw_input('>>> ')
             except EOFError:
                 break
             if phrase:
-                print self.get_reply(phrase)
+                print get_reply(phrase)
+
+    def make_server(self, address=None, http=None, pending=64, batch=1000, interval=1.0):
+        """A Server for many clients at once, with a line based protocol on
+        address and JSON over HTTP on http, both (host, port) pairs"""
+        return Server(self.__brain, address, http, pending, batch, interval)
+
+    def serve(self, address=None, http=None, pending=64, batch=1000, interval=1.0):
+        """Serve clients until interrupted, see make_server"""
+        server = self.make_server(address, http, pending, batch, interval)
+        server.start()
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.stop()
+
+    def export(self, file):
+        """Write a read-only copy of the brain that can be opened by many processes at once"""
+        self.__brain.export(file)
 
     def sync(self):
         """Flush any changes to disk"""